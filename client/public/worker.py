@@ -1,38 +1,112 @@
 from js import WebSocket, webSocketAddress, onFinished
 import pickle
-import json
-import base64
 from typing import Any
 from time import sleep
 
+from pyodide.ffi import to_js
+
 import micropip
 await micropip.install('cloudpickle')
+await micropip.install('msgpack')
+
+import msgpack
 
 
 !!INSTALL_DEPENDENCIES!!
 
 
+PICKLE_PROTOCOL = 5
+
 map_function = None
-def set_map_function(code: str):
+resources = {}
+def inject_resources():
+    # Ufuncs and builtins have no __globals__; they cannot reference
+    # broadcast resources anyway, so there is nothing to inject.
+    function_globals = getattr(map_function, "__globals__", None)
+    if function_globals is not None:
+        function_globals.update(resources)
+
+def set_map_function(payload: bytes):
     global map_function
-    map_function = pickle.loads(base64.b64decode(code))
+    map_function = pickle.loads(payload)
+    inject_resources()
+
+def set_resource(message: dict):
+    resources[message["name"]] = pickle.loads(
+        message["value"], buffers=message.get("buffers") or ()
+    )
+    if map_function is not None:
+        inject_resources()
 
 socket = None
 
-def execute_map(data: str) -> Any:
-    decoded_data = pickle.loads(base64.b64decode(data))
-    result = map_function(decoded_data)
-    encoded_result = base64.b64encode(pickle.dumps(result)).decode('utf-8')
-    socket.send(json.dumps({"type": "result", "value": encoded_result}))
+def send(message: dict):
+    socket.send(to_js(msgpack.packb(message, use_bin_type=True)))
+
+def execute_batch(tasks: list) -> Any:
+    results = [(index, map_function(pickle.loads(data))) for index, data in tasks]
+    buffers = []
+    body = pickle.dumps(results, protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)
+    send({
+        "type": "batch_result",
+        "value": body,
+        "buffers": [buffer.raw().tobytes() for buffer in buffers],
+    })
+    onFinished()
+
+
+def execute_batch_array(message: dict) -> Any:
+    # numpy is only present when it is in the server's package list, so
+    # import it lazily here.
+    import numpy as np
+
+    def spot_check(values, result):
+        # int64 arithmetic wraps silently instead of raising, so verify
+        # the vectorized answer against a per-element recomputation at
+        # the batch extremes — where overflow strikes first.
+        for index in {int(np.argmin(values)), int(np.argmax(values))}:
+            if result[index] != map_function(values[index].item()):
+                return False
+        return True
+
+    ids = message["ids"]
+    values = np.frombuffer(message["value"], dtype=message["dtype"])
+    try:
+        result = map_function(values)
+        if (
+            isinstance(result, np.ndarray)
+            and len(result) == len(ids)
+            and spot_check(values, result)
+        ):
+            send({
+                "type": "batch_array_result",
+                "ids": ids,
+                "dtype": str(result.dtype),
+                "value": result.tobytes(),
+            })
+            onFinished()
+            return
+    except Exception:
+        pass
+    results = [(index, map_function(data)) for index, data in zip(ids, values.tolist())]
+    buffers = []
+    body = pickle.dumps(results, protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)
+    send({
+        "type": "batch_result",
+        "value": body,
+        "buffers": [buffer.raw().tobytes() for buffer in buffers],
+    })
     onFinished()
 
 
 def handle_message(event):
-    message = json.loads(event.data)
+    message = msgpack.unpackb(event.data.to_py().tobytes(), raw=False)
     {
-        "function": set_map_function,
-        "data": execute_map,
-    }[message['type']](message['value'])
+        "function": lambda m: set_map_function(m["value"]),
+        "batch": lambda m: execute_batch(m["tasks"]),
+        "batch_array": execute_batch_array,
+        "resource": set_resource,
+    }[message["type"]](message)
 
 
 def wait_and_start_websocket(_):
@@ -41,11 +115,12 @@ def wait_and_start_websocket(_):
     start_websocket()
 
 
-def start_websocket(): 
+def start_websocket():
     global socket
     socket = WebSocket.new(webSocketAddress)
+    socket.binaryType = 'arraybuffer'
     socket.addEventListener('close', wait_and_start_websocket)
     socket.addEventListener('message', handle_message)
-    socket.addEventListener('open', lambda _: socket.send(json.dumps({"type": "ready", "value": None})))
+    socket.addEventListener('open', lambda _: send({"type": "ready"}))
 
 start_websocket()
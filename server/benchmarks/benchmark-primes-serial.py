@@ -1,38 +1,34 @@
 import logging
 from time import time
 
+import numpy as np
 import pandas as pd
 from constants import columns, n_reps
 from tqdm import tqdm
 
+N = 5000000
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
     df = pd.DataFrame(columns=columns)
 
-    def nth_prime(x):
-        n = 5000000
-        prime = [True for i in range(n + 1)]
-
-        p = 2
-        while p * p <= n:
-            if prime[p] == True:
-                for i in range(p * p, n + 1, p):
-                    prime[i] = False
-
-            p += 1
-
-        primes = []
-        for p in range(2, n + 1):
-            if prime[p]:
-                primes.append(p)
-
-        return primes[x]
-
     numbers = list(range(1000))
     for i in range(n_reps):
         start = time()
 
+        # One NumPy sieve per repetition instead of one Python-list sieve
+        # per number (see test-primes-serial.py).
+        sieve = np.ones(N + 1, dtype=bool)
+        sieve[:2] = False
+        for p in range(2, int(N ** 0.5) + 1):
+            if sieve[p]:
+                sieve[p * p :: p] = False
+        primes = np.flatnonzero(sieve)
+
+        def nth_prime(x):
+            return int(primes[x])
+
         results = list(tqdm(map(nth_prime, numbers), total=len(numbers)))
 
         end = time()
@@ -5,12 +5,14 @@ sys.path.append("..")
 import logging
 from time import time
 
+import numpy as np
 import pandas as pd
 from constants import columns, n_reps
 
 from distributed_execution import DistributedExecution
 
 CHUNK_SIZE = 1
+N = 5000000
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -19,30 +21,25 @@ if __name__ == "__main__":
 
     df = pd.DataFrame(columns=columns)
 
-    def nth_prime(x):
-        n = 5000000
-        prime = [True for i in range(n + 1)]
-
-        p = 2
-        while p * p <= n:
-            if prime[p] == True:
-                for i in range(p * p, n + 1, p):
-                    prime[i] = False
-
-            p += 1
+    # Workers fill the memo with one NumPy sieve and index into it for
+    # every task (see test-primes-serial.py for the sieve itself).
+    _primes = []
 
-        primes = []
-        for p in range(2, n + 1):
-            if prime[p]:
-                primes.append(p)
-
-        return primes[x]
+    def nth_prime(x):
+        if not _primes:
+            sieve = np.ones(N + 1, dtype=bool)
+            sieve[:2] = False
+            for p in range(2, int(N ** 0.5) + 1):
+                if sieve[p]:
+                    sieve[p * p :: p] = False
+            _primes.append(np.flatnonzero(sieve))
+        return int(_primes[0][x])
 
     for i in range(n_reps):
 
         start = time()
 
-        with DistributedExecution() as d:
+        with DistributedExecution(packages=["numpy"]) as d:
             results = d.map(nth_prime, numbers, chunk_size=CHUNK_SIZE)
 
         end = time()
@@ -41,16 +41,16 @@ VECTOR_COUNT = 1000
 if __name__ == "__main__":
     df = pd.DataFrame(columns=columns)
 
-    for _ in range(n_reps):        
+    for _ in range(n_reps):
         A = np.random.random((SIZE, SIZE))
 
-        def vector_multiplication(v: np.ndarray) -> np.ndarray:
-            return np.dot(A, v)
-
         vectors = [np.random.random(SIZE) for _ in range(VECTOR_COUNT)]
         start = time()
 
-        results = list(tqdm(map(vector_multiplication, vectors), total=len(vectors)))
+        # One GEMM over all stacked vectors (see test-vec-serial.py).
+        V = np.asfortranarray(np.stack(vectors, axis=1))
+        product = A @ V
+        results = [product[:, i] for i in tqdm(range(VECTOR_COUNT))]
 
         end = time()
         print(end - start)
@@ -1,28 +1,24 @@
 import logging
 
+import numpy as np
 from tqdm import tqdm
 
+N = 5000000
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
-    def nth_prime(x):
-        n = 5000000
-        prime = [True for i in range(n + 1)]
-
-        p = 2
-        while p * p <= n:
-            if prime[p] == True:
-                for i in range(p * p, n + 1, p):
-                    prime[i] = False
+    # The sieve is identical for every task, so compute it once up
+    # front; each slice assignment is a single vectorized store.
+    sieve = np.ones(N + 1, dtype=bool)
+    sieve[:2] = False
+    for p in range(2, int(N ** 0.5) + 1):
+        if sieve[p]:
+            sieve[p * p :: p] = False
+    primes = np.flatnonzero(sieve)
 
-            p += 1
-
-        primes = []
-        for p in range(2, n + 1):
-            if prime[p]:
-                primes.append(p)
-
-        return primes[x]
+    def nth_prime(x):
+        return int(primes[x])
 
     numbers = list(range(100))
     results = list(tqdm(map(nth_prime, numbers), total=len(numbers)))
@@ -4,31 +4,31 @@ sys.path.append("..")
 
 import logging
 
+import numpy as np
+
 from distributed_execution import DistributedExecution
 
+N = 5000000
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
     numbers = list(range(100))
 
-    def nth_prime(x):
-        n = 5000000
-        prime = [True for i in range(n + 1)]
-
-        p = 2
-        while p * p <= n:
-            if prime[p] == True:
-                for i in range(p * p, n + 1, p):
-                    prime[i] = False
+    # The sieve is identical for every task; workers fill the memo with
+    # one NumPy sieve (each composite-marking pass is a vectorized slice
+    # store) and every subsequent nth_prime call is a single array index.
+    _primes = []
 
-            p += 1
-
-        primes = []
-        for p in range(2, n + 1):
-            if prime[p]:
-                primes.append(p)
-
-        return primes[x]
-
-    with DistributedExecution() as d:
+    def nth_prime(x):
+        if not _primes:
+            sieve = np.ones(N + 1, dtype=bool)
+            sieve[:2] = False
+            for p in range(2, int(N ** 0.5) + 1):
+                if sieve[p]:
+                    sieve[p * p :: p] = False
+            _primes.append(np.flatnonzero(sieve))
+        return int(_primes[0][x])
+
+    with DistributedExecution(packages=["numpy"]) as d:
         results = d.map(nth_prime, numbers, chunk_size=1)
@@ -12,7 +12,8 @@ if __name__ == "__main__":
     A = np.random.random((SIZE, SIZE))
     vectors = [np.random.random(SIZE) for i in range(VECTOR_COUNT)]
 
-    def vector_multiplication(v: np.ndarray) -> np.ndarray:
-        return np.dot(A, v)
-
-    results = list(tqdm(map(vector_multiplication, vectors), total=len(vectors)))
+    # A single GEMM over all stacked vectors beats one GEMV call per
+    # vector: BLAS cache-blocks A across all right-hand-side columns.
+    V = np.asfortranarray(np.stack(vectors, axis=1))
+    product = A @ V
+    results = [product[:, i] for i in tqdm(range(VECTOR_COUNT))]
@@ -1,27 +1,46 @@
-import base64
-import json
+import asyncio
+import itertools
 import logging
-import multiprocessing
 import pathlib
 import pickle
+import random
+from collections import deque
 from dataclasses import dataclass
-from functools import lru_cache
-from threading import Thread
-from time import sleep, time
-from typing import Any, Callable, Iterable, List, Tuple
+from threading import Event, Lock, Thread
+from time import time
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from weakref import WeakKeyDictionary
 
 import cloudpickle
+import msgpack
+import numpy as np
 import uvicorn
+import uvloop
+import websockets
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from tqdm import tqdm as tqdm_regular
 from tqdm.notebook import tqdm_notebook
-from websocket_server import WebsocketServer
 
 logger = logging.getLogger("DistributedExecution")
 
+uvloop.install()
+
+# Pickle protocol 5 supports out-of-band buffers and is the fastest
+# protocol available on the bundled Python 3.9.
+PICKLE_PROTOCOL = 5
+
+# Messages are msgpack maps sent as binary frames; msgpack encodes the
+# pickled payload bytes natively, so the envelope costs a few bytes
+# instead of a JSON + base64 round-trip.
+
+# cloudpickle.dumps is slow enough to matter on reconnect storms, so
+# serialized function frames are memoized per function object. Weak keys
+# keep the cache from pinning user functions alive.
+_function_frames: "WeakKeyDictionary[Callable, bytes]" = WeakKeyDictionary()
+
 
 def is_in_notebook() -> bool:
     try:
@@ -41,7 +60,7 @@ class ClientTask:
     time_to_live: int
 
 
-def run_fastapi(packages: List[str], server_port: int):
+def create_fastapi_app(packages: List[str]) -> FastAPI:
     app = FastAPI()
     app.add_middleware(CORSMiddleware, allow_origins=["*"])
 
@@ -59,7 +78,7 @@ def run_fastapi(packages: List[str], server_port: int):
         name="static",
     )
 
-    uvicorn.run(app=app, host="0.0.0.0", port=server_port)
+    return app
 
 
 class DistributedExecution:
@@ -71,20 +90,28 @@ class DistributedExecution:
         timeout_in_seconds=60,
     ):
         self._timeout_in_seconds = timeout_in_seconds
-        self._server = WebsocketServer(
-            host="0.0.0.0", port=websocket_port, loglevel=logging.INFO
-        )
-        self._server.set_fn_new_client(self._on_new_client)
-        self._server.set_fn_client_left(self._on_client_lost)
-        self._server.set_fn_message_received(self._on_message)
-
+        self._websocket_port = websocket_port
         self._server_port = server_port
         self._packages = packages
 
-        self._clients_ready = []
-        self._client_tasks: List[ClientTask] = []
-        self._tasks: List[Tuple[int, Any]] = []
-        self._map_function = None
+        self._loop = None
+        self._websocket_thread = None
+        self._websocket_server = None
+        self._webserver = None
+        self._webserver_future = None
+        self._client_ids = itertools.count()
+
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._clients: Dict[int, Any] = {}
+        self._client_queues: Dict[int, deque] = {}
+        self._idle_clients = set()
+        self._client_tasks: Dict[int, ClientTask] = {}
+        self._pending: deque = deque()
+        self._chunk_size = 1
+        self._serialized_tasks: Dict[int, bytes] = {}
+        self._resources: Dict[str, bytes] = {}
+        self._current_function_frame = None
         self._progress = None
         self._completed: List[Tuple[int, Any]] = []
         self._is_active = False
@@ -92,151 +119,405 @@ class DistributedExecution:
         logger.info(f"Created")
 
     def _start_webserver(self):
-        self._webserver_process = multiprocessing.Process(
-            target=run_fastapi,
-            args=(self._packages, self._server_port)
+        # The sidecar only serves static files and /packages; running it
+        # as a task on the websocket loop avoids forking the whole parent
+        # process (hundreds of MB RSS once NumPy is loaded).
+        self._webserver = uvicorn.Server(
+            uvicorn.Config(
+                app=create_fastapi_app(self._packages),
+                host="0.0.0.0",
+                port=self._server_port,
+            )
+        )
+        # Signal handlers can only be installed on the main thread.
+        self._webserver.install_signal_handlers = lambda: None
+        self._webserver_future = asyncio.run_coroutine_threadsafe(
+            self._webserver.serve(), self._loop
         )
-        self._webserver_process.start()
         logger.info(f"Web server started on http://0.0.0.0:{self._server_port}")
 
+    def _stop_webserver(self):
+        self._webserver.should_exit = True
+        self._webserver_future.result()
+        self._webserver = None
+        logger.info(f"Web server stopped")
+
+    def _start_websocket_server(self):
+        self._loop = asyncio.new_event_loop()
+        started = Event()
+
+        def run_loop():
+            asyncio.set_event_loop(self._loop)
+            self._websocket_server = self._loop.run_until_complete(
+                # max_size=None: resource frames can be far larger than the
+                # 1 MiB default.
+                websockets.serve(
+                    self._handler, "0.0.0.0", self._websocket_port, max_size=None
+                )
+            )
+            started.set()
+            self._loop.run_forever()
+
+        self._websocket_thread = Thread(target=run_loop, daemon=True)
+        self._websocket_thread.start()
+        started.wait()
+        logger.info(
+            f"WebSocket server started on ws://0.0.0.0:{self._websocket_port}"
+        )
+
+    def _stop_websocket_server(self):
+        async def shutdown():
+            # Wait for the connection handlers to finish and drain any
+            # stragglers before stopping the loop; stopping immediately
+            # after close() destroys their tasks while still pending and
+            # litters stderr with tracebacks.
+            self._websocket_server.close()
+            await self._websocket_server.wait_closed()
+            remaining = [
+                task
+                for task in asyncio.all_tasks()
+                if task is not asyncio.current_task()
+            ]
+            for task in remaining:
+                task.cancel()
+            await asyncio.gather(*remaining, return_exceptions=True)
+            self._loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+        self._websocket_thread.join()
+        self._loop.close()
+        self._loop = None
+        self._websocket_server = None
+        logger.info(f"WebSocket server stopped")
+
+    async def _handler(self, websocket, path=None):
+        client = {
+            "id": next(self._client_ids),
+            "address": websocket.remote_address,
+            "socket": websocket,
+        }
+        self._on_new_client(client)
+        try:
+            async for message in websocket:
+                self._on_message(client, message)
+        except websockets.ConnectionClosedError:
+            pass
+        finally:
+            self._on_client_lost(client)
+
+    def _send(self, client, frame):
+        async def send():
+            try:
+                await client["socket"].send(frame)
+            except websockets.ConnectionClosed:
+                pass
+
+        asyncio.run_coroutine_threadsafe(send(), self._loop)
+
+    def _broadcast(self, frame):
+        if self._loop is None:
+            return
+        sockets = [client["socket"] for client in self._clients.values()]
+        self._loop.call_soon_threadsafe(websockets.broadcast, sockets, frame)
+
     def map(
         self,
         function: Callable[[Any], Any],
         values: Iterable[Any],
         chunk_size=1,
     ) -> List[Any]:
-        values = list(enumerate(values))
-
-        def map_function(v):
-            i, d = v
-            return i, function(d)
+        self._pending = deque(enumerate(values))
+        self._chunk_size = chunk_size
+        total = len(self._pending)
 
-        self._map_function = map_function
+        # The user function is sent as-is; clients apply it to the data
+        # half of each (index, data) task and answer (index, result).
+        # Serializing once up front means late-joining clients get the
+        # cached bytes instead of a fresh cloudpickle run each.
+        self._current_function_frame = self._serialize_function(function)
 
         last_time = time()
-        websocket_thread = Thread(target=self._server.serve_forever)
-        websocket_thread.start()
-        logger.info(
-            f"WebSocket server started on ws://{self._server.host}:{self._server.port}"
-        )
-
+        self._start_websocket_server()
         self._start_webserver()
 
         self._is_active = True
-        self._server.send_message_to_all(self._serialize_function(function))
-        self._progress = tqdm(total=len(values))
-        while self._tasks or values or self._client_tasks:
-            while len(self._tasks) >= chunk_size or (not values and self._tasks):
-                while not self._clients_ready:
-                    sleep(0)
-                client = self._clients_ready.pop(0)
-                for _ in range(min(chunk_size, len(self._tasks))):
-                    task = self._tasks.pop(0)
-                    try:
-                        self._client_tasks.append(
-                            ClientTask(
-                                client=client,
-                                task=task,
-                                time_to_live=self._timeout_in_seconds,
-                            )
-                        )
-                        self._server.send_message(client, self._serialize_data(task))
-                    except BrokenPipeError:
-                        pass
+        self._broadcast(self._current_function_frame)
+        self._progress = tqdm(total=total)
+        with self._lock:
+            for client in list(self._clients.values()):
+                self._fill_client(client)
+
+        while len(self._completed) < total:
+            # Sleep until a callback signals progress; the 1-second timeout
+            # drives the time-to-live sweep.
+            self._wakeup.wait(timeout=1.0)
+            self._wakeup.clear()
 
             current_time = time()
             delta = current_time - last_time
             if delta > 1:
                 last_time = current_time
-                for t in self._client_tasks:
-                    t.time_to_live -= delta
-                timed_out = [t for t in self._client_tasks if t.time_to_live < 0]
-                for t in timed_out:
-                    logger.warning(f"Task {t.task[0]} timed out, retrying")
-                    self._client_tasks.remove(t)
-                    values.append(t.task)
-
-            sleep(0)
-
-            while values and len(self._tasks) < chunk_size:
-                self._tasks.append(values.pop(0))
+                with self._lock:
+                    for task_id, t in list(self._client_tasks.items()):
+                        t.time_to_live -= delta
+                        if t.time_to_live < 0:
+                            logger.warning(f"Task {task_id} timed out, retrying")
+                            self._client_tasks.pop(task_id)
+                            self._remove_from_queue(t.client["id"], task_id)
+                            self._pending.appendleft(t.task)
+                    for client_id in list(self._idle_clients):
+                        client = self._clients.get(client_id)
+                        if client is not None and self._pending:
+                            self._fill_client(client)
 
         actual_completed = [d for _, d in sorted(self._completed)]
-        self._server.shutdown_gracefully()
-        websocket_thread.join()
-        logger.info(f"WebSocket server stopped")
-
-        self._webserver_process.terminate()
-        logger.info(f"Web server stopped")
-
-        self._clients_ready = []
-        self._client_tasks = []
-        self._tasks = []
-        self._map_function = None
+        self._stop_webserver()
+        self._stop_websocket_server()
+
+        self._clients = {}
+        self._client_queues = {}
+        self._idle_clients = set()
+        self._client_tasks = {}
+        self._pending = deque()
+        self._serialized_tasks = {}
+        self._current_function_frame = None
         self._progress = None
         self._completed = []
         self._is_active = False
+        self._wakeup.clear()
 
         return actual_completed
 
-    @staticmethod
-    @lru_cache(maxsize=20)
-    def _serialize_function(function: Callable[[Any], Any]) -> str:
-        return json.dumps(
+    def broadcast(self, name: str, obj: Any):
+        """Ship `obj` once to all current and future clients.
+
+        Clients store it under `name` in the globals of the mapped
+        function, so the function can reference it without closing over
+        it — broadcasting a large array once is much cheaper than
+        pickling it into every function frame.
+        """
+        # Resources are the largest payloads on the wire (whole matrices),
+        # so their array data travels as out-of-band protocol-5 buffers
+        # rather than being copied through the pickle stream.
+        buffers = []
+        body = pickle.dumps(obj, protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)
+        frame = msgpack.packb(
             {
-                "type": "function",
-                "value": base64.b64encode(cloudpickle.dumps(function)).decode("utf-8"),
-            }
+                "type": "resource",
+                "name": name,
+                "value": body,
+                "buffers": [buffer.raw().tobytes() for buffer in buffers],
+            },
+            use_bin_type=True,
+        )
+        with self._lock:
+            self._resources[name] = frame
+            self._broadcast(frame)
+
+    def _dispatch_tasks(self, client, tasks):
+        """Assign `tasks` to a client and send them as one batch frame."""
+        if not tasks:
+            return
+        queue = self._client_queues[client["id"]]
+        for task in tasks:
+            self._client_tasks[task[0]] = ClientTask(
+                client=client,
+                task=task,
+                time_to_live=self._timeout_in_seconds,
+            )
+            queue.append(task)
+        self._send(client, self._serialize_batch(tasks))
+
+    def _fill_client(self, client):
+        """Refill a client's private queue from the pending deque, stealing
+        from a busy client when no pending work is left."""
+        queue = self._client_queues[client["id"]]
+        batch = []
+        while self._pending and len(queue) + len(batch) < self._chunk_size:
+            batch.append(self._pending.popleft())
+        self._dispatch_tasks(client, batch)
+        if not queue and not self._steal_for(client):
+            self._idle_clients.add(client["id"])
+        else:
+            self._idle_clients.discard(client["id"])
+
+    def _steal_for(self, thief) -> bool:
+        """Move the tail half of a random busy client's queue to the thief.
+
+        Stolen tasks were already sent to the victim, so they are
+        re-dispatched speculatively; whichever client answers first wins
+        and the duplicate result is dropped in `_on_get_result`.
+        """
+        victims = [
+            client_id
+            for client_id, queue in self._client_queues.items()
+            if client_id != thief["id"] and len(queue) > 1
+        ]
+        if not victims:
+            return False
+        victim_queue = self._client_queues[random.choice(victims)]
+        stolen = [victim_queue.pop() for _ in range(len(victim_queue) // 2)]
+        self._dispatch_tasks(thief, stolen)
+        return True
+
+    def _remove_from_queue(self, client_id, task_id):
+        queue = self._client_queues.get(client_id)
+        if queue is None:
+            return
+        for index, task in enumerate(queue):
+            if task[0] == task_id:
+                del queue[index]
+                break
+
+    @staticmethod
+    def _pack_function(function: Callable[[Any], Any]) -> bytes:
+        return msgpack.packb(
+            {"type": "function", "value": cloudpickle.dumps(function)},
+            use_bin_type=True,
         )
 
     @staticmethod
-    def _serialize_data(data: Any) -> str:
-        return json.dumps(
+    def _serialize_function(function: Callable[[Any], Any]) -> bytes:
+        try:
+            frame = _function_frames.get(function)
+        except TypeError:
+            # Not weak-referenceable (e.g. NumPy ufuncs); serialize uncached.
+            return DistributedExecution._pack_function(function)
+        if frame is None:
+            frame = DistributedExecution._pack_function(function)
+            _function_frames[function] = frame
+        return frame
+
+    def _serialize_task(self, task_id: int, data: Any) -> bytes:
+        # Retries and steals re-send identical payloads; cache the pickled
+        # bytes per task id and evict once the result is in, so memory is
+        # bounded by the inflight task count.
+        payload = self._serialized_tasks.get(task_id)
+        if payload is None:
+            payload = pickle.dumps(data, protocol=PICKLE_PROTOCOL)
+            self._serialized_tasks[task_id] = payload
+        return payload
+
+    def _serialize_batch(self, tasks: List[Tuple[int, Any]]) -> bytes:
+        # Homogeneous int batches go out as one raw int64 array; the
+        # client applies the function to the whole array (SIMD via NumPy
+        # when the function is elementwise) and answers with raw array
+        # bytes, skipping pickle per element entirely. Only int32-range
+        # values are specialized: larger ones would overflow the int64
+        # conversion outright, and ndarray arithmetic wraps at int64
+        # where the per-element path promotes to arbitrary precision, so
+        # this keeps common elementwise results (products, squares)
+        # exact. Everything else falls through to the pickled path.
+        if len(tasks) > 1 and all(
+            type(data) is int and -(2 ** 31) <= data < 2 ** 31
+            for _, data in tasks
+        ):
+            values = np.asarray([data for _, data in tasks], dtype=np.int64)
+            return msgpack.packb(
+                {
+                    "type": "batch_array",
+                    "ids": [task_id for task_id, _ in tasks],
+                    "dtype": str(values.dtype),
+                    "value": values.tobytes(),
+                },
+                use_bin_type=True,
+            )
+
+        # Task ids ride along as native msgpack ints; only the data half
+        # of each task is pickled, so no (index, data) tuple is ever on
+        # the wire — for single-int workloads that halves the bytes sent.
+        return msgpack.packb(
             {
-                "type": "data",
-                "value": base64.b64encode(pickle.dumps(data)).decode("utf-8"),
-            }
+                "type": "batch",
+                "tasks": [
+                    (task_id, self._serialize_task(task_id, data))
+                    for task_id, data in tasks
+                ],
+            },
+            use_bin_type=True,
         )
 
-    def _on_new_client(self, client, server):
+    def _on_new_client(self, client):
         logger.info(f"WebSocket client joined: {client['address']}")
-        if self._map_function:
-            server.send_message(client, self._serialize_function(self._map_function))
-        self._clients_ready.append(client)
-
-    def _on_client_lost(self, client, server):
-        logger.info(f"WebSocket client left: {client}")
-        if client in self._clients_ready:
-            self._clients_ready.remove(client)
-
-    def _on_message(self, client, server, message):
+        with self._lock:
+            self._clients[client["id"]] = client
+            self._client_queues[client["id"]] = deque()
+            for frame in self._resources.values():
+                self._send(client, frame)
+            if self._current_function_frame:
+                self._send(client, self._current_function_frame)
+            if self._is_active:
+                self._fill_client(client)
+            else:
+                self._idle_clients.add(client["id"])
+        self._wakeup.set()
+
+    def _on_client_lost(self, client):
+        logger.info(f"WebSocket client left: {client['address']}")
+        with self._lock:
+            self._clients.pop(client["id"], None)
+            self._idle_clients.discard(client["id"])
+            queue = self._client_queues.pop(client["id"], None)
+            if queue:
+                for task in queue:
+                    self._client_tasks.pop(task[0], None)
+                    self._pending.appendleft(task)
+        self._wakeup.set()
+
+    def _on_message(self, client, message):
         if not self._is_active:
             return
 
-        message = json.loads(message)
-        {
-            "ready": lambda *_: self._clients_ready.append(client),
-            "result": self._on_get_result,
-        }[message["type"]](client, message["value"])
-
-    def _on_get_result(self, client, result):
-        decoded_result = pickle.loads(base64.b64decode(result))
-        client_task = [t for t in self._client_tasks if t.task[0] == decoded_result[0]]
-        if client_task:
-            self._client_tasks.remove(client_task[0])
-        else:
+        message = msgpack.unpackb(message, raw=False)
+        with self._lock:
+            {
+                "ready": lambda *_: self._fill_client(client),
+                "result": self._on_get_result,
+                "batch_result": self._on_get_batch_result,
+                "batch_array_result": self._on_get_batch_array_result,
+            }[message["type"]](client, message)
+        self._wakeup.set()
+
+    def _handle_result(self, decoded_result):
+        client_task = self._client_tasks.pop(decoded_result[0], None)
+        if client_task is None:
             return
-
-        if not [t for t in self._client_tasks if t.client == client]:
-            self._clients_ready.append(client)
-
+        self._serialized_tasks.pop(decoded_result[0], None)
+        self._remove_from_queue(client_task.client["id"], decoded_result[0])
         self._completed.append(decoded_result)
         self._progress.update(1)
 
+    @staticmethod
+    def _decode_payload(message):
+        # Large result arrays arrive as out-of-band protocol-5 buffers in
+        # the envelope, so unpickling references them instead of copying
+        # them out of the pickle stream.
+        return pickle.loads(
+            message["value"], buffers=message.get("buffers") or ()
+        )
+
+    def _on_get_result(self, client, message):
+        self._handle_result(self._decode_payload(message))
+        self._fill_client(client)
+
+    def _on_get_batch_result(self, client, message):
+        for decoded_result in self._decode_payload(message):
+            self._handle_result(decoded_result)
+        self._fill_client(client)
+
+    def _on_get_batch_array_result(self, client, message):
+        values = np.frombuffer(message["value"], dtype=message["dtype"])
+        # tolist() hands back native Python scalars, matching what a
+        # per-element map would have produced.
+        for decoded_result in zip(message["ids"], values.tolist()):
+            self._handle_result(decoded_result)
+        self._fill_client(client)
+
     def __enter__(self):
         logger.info(f"Initiated")
         return self
 
     def __exit__(self, type, value, traceback):
-        self._server.shutdown_gracefully()
+        if self._loop is not None:
+            self._stop_websocket_server()
         logger.info(f"Destroyed")
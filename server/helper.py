@@ -8,6 +8,11 @@ import psutil
 
 
 def start_server(hostname: str, f: str, num_clients: int):
+    # Each worker gets its index so it can pin itself to its own core.
+    worker_commands = "\n".join(
+        f"python headless_client.py ws://127.0.0.1:7700 {i} &"
+        for i in range(num_clients)
+    )
     execute_on_host(
         hostname,
         f"""
@@ -15,7 +20,7 @@ def start_server(hostname: str, f: str, num_clients: int):
 
             cd Python-3.9.1
             alias python=`pwd`/python
-            cd -  
+            cd -
 
             python -m venv --copies .env
             source .env/bin/activate
@@ -24,10 +29,10 @@ def start_server(hostname: str, f: str, num_clients: int):
 
             source .env/bin/activate
 
-            {'python headless_client.py ws://127.0.0.1:7700 &' * num_clients}
+            {worker_commands}
 
             cd benchmarks
-            python {f} {num_clients} 
+            python {f} {num_clients}
         """,
     )
 